@@ -11,12 +11,18 @@ from hasura_ndc import start
 from hasura_ndc.instrumentation import with_active_span # If you aren't planning on adding additional tracing spans, you don't need this!
 from opentelemetry.trace import get_tracer # If you aren't planning on adding additional tracing spans, you don't need this either!
 from hasura_ndc.function_connector import FunctionConnector
-from pydantic import BaseModel, Field # You only need this import if you plan to have complex inputs/outputs, which function similar to how frameworks like FastAPI do
+from pydantic import BaseModel, ConfigDict, Field # You only need this import if you plan to have complex inputs/outputs, which function similar to how frameworks like FastAPI do
 import asyncio # You might not need this import if you aren't doing asynchronous work
 from hasura_ndc.errors import UnprocessableContent
 from typing import Annotated
+import atexit
+import math
 import os
+import time
+from email.utils import parsedate_to_datetime
 import httpx
+import msgspec
+from cachetools import TTLCache
 
 connector = FunctionConnector()
 
@@ -119,8 +125,132 @@ def annotations(foo: Foo | None = Field(..., description="The optional input Foo
     """Writing a doc-string like this will become the function/procedure description"""
     return None
 
+# OpenSanctions API key
+# The key can't change once the connector container has started, so it is read once at import
+OPENSANCTIONS_API_KEY_ENV_VAR = "APP_OFAC_OPENSANCTIONS_API_KEY"
+
+def _read_api_key() -> str | None:
+    return os.getenv(OPENSANCTIONS_API_KEY_ENV_VAR)
+
+_API_KEY = _read_api_key()
+_AUTH_HEADERS = {"Authorization": f"Bearer {_API_KEY}"} if _API_KEY else None
+
+# Shared OpenSanctions HTTP client
+# A single pooled client keeps connections to api.opensanctions.org alive between calls,
+# so we only pay for DNS, TCP and TLS setup once instead of on every query.
+OPENSANCTIONS_BASE_URL = "https://api.opensanctions.org"
+# Pre-parsed once, so httpx doesn't re-parse the URL string on every call
+_OFAC_SEARCH_URL = httpx.URL(f"{OPENSANCTIONS_BASE_URL}/search/us_ofac_sdn")
+
+_client: httpx.AsyncClient | None = None
+
+# There is no await between the check and the assignment, so the event loop keeps this atomic
+async def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            http2=True, # Lets concurrent OFAC queries multiplex over one connection
+            # No explicit Accept-Encoding: httpx advertises gzip and, with the brotli extra
+            # installed, br, so it never asks for an encoding it can't decode
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            timeout=httpx.Timeout(10.0)
+        )
+    return _client
+
+@atexit.register
+def _close_client():
+    if _client is not None and not _client.is_closed:
+        try:
+            asyncio.run(_client.aclose())
+        except Exception:
+            pass # The process is exiting anyway, the OS will reclaim the sockets
+
+# Circuit breaker for OpenSanctions
+# After a 429 or 5xx we stop calling upstream for a while (exponential backoff, or longer if the
+# server sent Retry-After), so callers fail fast instead of adding to the retry storm.
+# All mutations happen without an await in between, so the event loop keeps them atomic.
+_BREAKER = {"open_until": 0.0, "opened_at": 0.0, "consec_fail": 0}
+# Upper bound on how long a Retry-After header alone can keep the breaker open
+_MAX_RETRY_AFTER_SECONDS = 300.0
+
+def _breaker_is_open() -> bool:
+    return time.monotonic() < _BREAKER["open_until"]
+
+def _retry_after_seconds(response: httpx.Response) -> float:
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return 0.0
+    try:
+        seconds = float(retry_after)
+    except ValueError:
+        try: # Retry-After can also be an HTTP date
+            seconds = parsedate_to_datetime(retry_after).timestamp() - time.time()
+        except (TypeError, ValueError, OverflowError):
+            return 0.0
+    # Don't let a bogus value (inf, nan, negative, far future) hold the breaker open indefinitely
+    if not math.isfinite(seconds) or seconds < 0:
+        return 0.0
+    return min(seconds, _MAX_RETRY_AFTER_SECONDS)
+
+# sent_at is the time.monotonic() reading taken just before the request was sent
+def _record_upstream_response(response: httpx.Response, sent_at: float):
+    if response.status_code == 429 or response.status_code >= 500:
+        now = time.monotonic()
+        # Requests already in flight when the breaker opened are part of the same incident
+        if now < _BREAKER["open_until"]:
+            return
+        _BREAKER["consec_fail"] += 1
+        backoff = min(60, 2 ** _BREAKER["consec_fail"])
+        _BREAKER["opened_at"] = now
+        _BREAKER["open_until"] = now + max(backoff, _retry_after_seconds(response))
+    elif response.status_code == 200 and sent_at >= _BREAKER["opened_at"]:
+        # Only a request sent after the breaker last opened shows upstream has recovered,
+        # a 200 that was already in flight when it tripped says nothing about the current state
+        _BREAKER["consec_fail"] = 0
+        _BREAKER["open_until"] = 0.0
+
+# Sanctions lists change over hours to days, so successful responses are cached in-process
+# for an hour. Failed lookups are never cached so they get retried on the next call.
+_SEARCH_CACHE: TTLCache = TTLCache(maxsize=4096, ttl=3600)
+
+# OpenSanctions response shapes
+# The search payload is decoded straight from bytes into these typed structs, which is much
+# cheaper than json.loads followed by a chain of dict lookups. Unknown fields are ignored.
+# They only ever hold strings, numbers and lists, so they are frozen and excluded from GC tracking.
+# The public models below stay Pydantic since the FunctionConnector builds the schema from them.
+class _OSProps(msgspec.Struct, omit_defaults=True, frozen=True, gc=False):
+    name: list[str] = []
+    country: list[str] = []
+    address: list[str] = []
+    birthDate: list[str] = []
+    createdAt: list[str] = []
+    programId: list[str] = []
+
+class _OSItem(msgspec.Struct, frozen=True, gc=False):
+    id: str = ""
+    caption: str = ""
+    schema_: str = msgspec.field(name="schema", default="")
+    properties: _OSProps = msgspec.field(default_factory=_OSProps)
+    score: float | None = None # Score might be added by search relevance
+
+class _OSTotal(msgspec.Struct, frozen=True, gc=False):
+    value: int = 0
+
+class _OSResp(msgspec.Struct, frozen=True, gc=False):
+    results: list[_OSItem] = []
+    total: int | _OSTotal = 0 # Can be an object or integer
+
+_DEC = msgspec.json.Decoder(_OSResp)
+
+# Extract the first value of a decoded property list, or "" when it is empty
+def _first(values: list[str]) -> str:
+    return values[0] if values else ""
+
 # OpenSanctions OFAC SDN Models
+# These are frozen because cached responses are shared between every caller that hits the cache
 class OfacSdnEntity(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     id: str = Field(..., description="Unique entity identifier")
     name: str = Field(..., description="Entity name")
     entity_type: str = Field(..., description="Type of entity (Person, Organization, etc.)")
@@ -133,23 +263,66 @@ class OfacSdnEntity(BaseModel):
     score: float | None = Field(None, description="Matching score")
 
 class SearchOfacSdnResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     success: bool = Field(..., description="Whether the search was successful")
     results: list[OfacSdnEntity] = Field(..., description="Search results")
     total_count: int = Field(..., description="Total number of results")
     error: str | None = Field(None, description="Error message if search failed")
 
 class MatchOfacEntityResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     success: bool = Field(..., description="Whether the match was successful")
     matches: list[OfacSdnEntity] = Field(..., description="Matching entities")
     error: str | None = Field(None, description="Error message if match failed")
 
+# Shared by search_ofac_sdn and match_ofac_entity, which both read the search API format
+def _build_entity(item: _OSItem) -> OfacSdnEntity:
+    # OpenSanctions API returns data in 'properties' nested structure
+    props = item.properties
+    # model_construct skips validation, which is only safe because the payload has
+    # already been type-checked by the msgspec decoder
+    return OfacSdnEntity.model_construct(
+        id=item.id,
+        name=item.caption or _first(props.name),
+        entity_type=item.schema_,  # Person, Organization, etc.
+        country=_first(props.country),
+        address=_first(props.address),
+        birth_date=_first(props.birthDate),
+        listed_date=_first(props.createdAt),
+        program=_first(props.programId),
+        list_type="SDN",  # This is OFAC SDN list
+        score=item.score
+    )
+
+# Concurrent cache misses for the same key share one upstream call instead of each making their own.
+# The fetch runs as its own task and is shielded, so a cancelled caller doesn't cancel it for the others.
+_INFLIGHT: dict[tuple, asyncio.Task] = {}
+
+async def _single_flight(key: tuple, fetch):
+    task = _INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fetch())
+        _INFLIGHT[key] = task
+        task.add_done_callback(lambda _: _INFLIGHT.pop(key, None))
+    return await asyncio.shield(task)
+
 # OpenSanctions OFAC SDN Search Function
-@connector.register_query
+# When the engine joins to these functions it sends the rows as variables, which the connector runs in
+# batches of parallel_degree. 20 matches the concurrency cap used by the bulk variants below.
+@connector.register_query(parallel_degree=20)
 async def search_ofac_sdn(query: str, limit: int | None = 10) -> SearchOfacSdnResponse:
     """Search the OFAC SDN sanctions database for entities matching the query"""
+    cache_key = ("sdn", query, limit)
+    cached = _SEARCH_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+    return await _single_flight(cache_key, lambda: _fetch_ofac_sdn(cache_key, query, limit))
+
+async def _fetch_ofac_sdn(cache_key: tuple, query: str, limit: int | None) -> SearchOfacSdnResponse:
     try:
-        api_key = os.getenv("APP_OFAC_OPENSANCTIONS_API_KEY")
-        if not api_key:
+        if _AUTH_HEADERS is None:
             return SearchOfacSdnResponse(
                 success=False,
                 results=[],
@@ -157,88 +330,90 @@ async def search_ofac_sdn(query: str, limit: int | None = 10) -> SearchOfacSdnRe
                 error="OpenSanctions API key not configured"
             )
 
+        if _breaker_is_open():
+            return SearchOfacSdnResponse(
+                success=False,
+                results=[],
+                total_count=0,
+                error="OpenSanctions is unavailable (circuit open), try again later"
+            )
+
         params = {"q": query}
         if limit:
             params["limit"] = str(limit)
 
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
+        client = await _get_client()
+        sent_at = time.monotonic()
+        response = await client.get(
+            _OFAC_SEARCH_URL,
+            params=params,
+            headers=_AUTH_HEADERS
+        )
+        _record_upstream_response(response, sent_at)
 
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                "https://api.opensanctions.org/search/us_ofac_sdn",
-                params=params,
-                headers=headers
+        if response.status_code != 200:
+            return SearchOfacSdnResponse(
+                success=False,
+                results=[],
+                total_count=0,
+                error=f"HTTP {response.status_code}: {response.text}"
             )
 
-            if response.status_code != 200:
-                return SearchOfacSdnResponse(
-                    success=False,
-                    results=[],
-                    total_count=0,
-                    error=f"HTTP {response.status_code}: {response.text}"
-                )
-
-            data = response.json()
-            results = []
-            
-            for item in data.get("results", []):
-                # OpenSanctions API returns data in 'properties' nested structure
-                props = item.get("properties", {})
-                
-                # Extract first value from arrays or use direct values
-                def get_first_or_value(prop_list):
-                    if isinstance(prop_list, list) and prop_list:
-                        return prop_list[0]
-                    return prop_list if prop_list else ""
-                
-                entity = OfacSdnEntity(
-                    id=item.get("id", ""),
-                    name=item.get("caption", get_first_or_value(props.get("name", []))),
-                    entity_type=item.get("schema", ""),  # Person, Organization, etc.
-                    country=get_first_or_value(props.get("country", [])),
-                    address=get_first_or_value(props.get("address", [])),
-                    birth_date=get_first_or_value(props.get("birthDate", [])),
-                    listed_date=get_first_or_value(props.get("createdAt", [])),
-                    program=get_first_or_value(props.get("programId", [])),
-                    list_type="SDN",  # This is OFAC SDN list
-                    score=item.get("score")  # Score might be added by search relevance
-                )
-                results.append(entity)
-
-            # Handle total_count which can be an object or integer
-            total_count = data.get("total", 0)
-            if isinstance(total_count, dict):
-                total_count = total_count.get("value", 0)
+        parsed = _DEC.decode(response.content)
+        results = [_build_entity(item) for item in parsed.results]
 
-            return SearchOfacSdnResponse(
-                success=True,
-                results=results,
-                total_count=total_count
-            )
+        # Handle total_count which can be an object or integer
+        total_count = parsed.total.value if type(parsed.total) is _OSTotal else parsed.total
 
-    except Exception as e:
+        search_response = SearchOfacSdnResponse.model_construct(
+            success=True,
+            results=results,
+            total_count=total_count
+        )
+        _SEARCH_CACHE[cache_key] = search_response
+        return search_response
+
+    # Only upstream failures become error responses, anything else is a bug and should surface
+    except httpx.HTTPError as e:
+        return SearchOfacSdnResponse(
+            success=False,
+            results=[],
+            total_count=0,
+            error=f"network: {e!r}"
+        )
+    except (msgspec.DecodeError, ValueError, KeyError) as e:
         return SearchOfacSdnResponse(
             success=False,
             results=[],
             total_count=0,
-            error=str(e)
+            error=f"parse: {e!r}"
         )
 
-@connector.register_query
+@connector.register_query(parallel_degree=20)
 async def match_ofac_entity(name: str, country: str | None = None, entity_type: str | None = None) -> MatchOfacEntityResponse:
     """Match an entity against the OFAC SDN sanctions database"""
+    cache_key = ("match", name, country, entity_type)
+    cached = _SEARCH_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+    return await _single_flight(cache_key, lambda: _fetch_ofac_match(cache_key, name, country))
+
+async def _fetch_ofac_match(cache_key: tuple, name: str, country: str | None) -> MatchOfacEntityResponse:
     try:
-        api_key = os.getenv("APP_OFAC_OPENSANCTIONS_API_KEY")
-        if not api_key:
+        if _AUTH_HEADERS is None:
             return MatchOfacEntityResponse(
                 success=False,
                 matches=[],
                 error="OpenSanctions API key not configured"
             )
 
+        if _breaker_is_open():
+            return MatchOfacEntityResponse(
+                success=False,
+                matches=[],
+                error="OpenSanctions is unavailable (circuit open), try again later"
+            )
+
         # Use search API instead of reconcile since match format is complex
         params = {"q": name}
         if country:
@@ -246,99 +421,111 @@ async def match_ofac_entity(name: str, country: str | None = None, entity_type:
         
         # Note: We'll use search API for now since reconcile API format is complex
 
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
+        client = await _get_client()
+        sent_at = time.monotonic()
+        response = await client.get(
+            _OFAC_SEARCH_URL,
+            params=params,
+            headers=_AUTH_HEADERS
+        )
+        _record_upstream_response(response, sent_at)
 
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                "https://api.opensanctions.org/search/us_ofac_sdn",
-                params=params,
-                headers=headers
+        if response.status_code != 200:
+            return MatchOfacEntityResponse(
+                success=False,
+                matches=[],
+                error=f"HTTP {response.status_code}: {response.text}"
             )
 
-            if response.status_code != 200:
-                return MatchOfacEntityResponse(
-                    success=False,
-                    matches=[],
-                    error=f"HTTP {response.status_code}: {response.text}"
-                )
-
-            data = response.json()
-            matches = []
-            
-            # Using search API format (same as search function)
-            for item in data.get("results", []):
-                # OpenSanctions API returns data in 'properties' nested structure
-                props = item.get("properties", {})
-                
-                # Extract first value from arrays or use direct values
-                def get_first_or_value(prop_list):
-                    if isinstance(prop_list, list) and prop_list:
-                        return prop_list[0]
-                    return prop_list if prop_list else ""
-                
-                entity = OfacSdnEntity(
-                    id=item.get("id", ""),
-                    name=item.get("caption", get_first_or_value(props.get("name", []))),
-                    entity_type=item.get("schema", ""),  # Person, Organization, etc.
-                    country=get_first_or_value(props.get("country", [])),
-                    address=get_first_or_value(props.get("address", [])),
-                    birth_date=get_first_or_value(props.get("birthDate", [])),
-                    listed_date=get_first_or_value(props.get("createdAt", [])),
-                    program=get_first_or_value(props.get("programId", [])),
-                    list_type="SDN",  # This is OFAC SDN list
-                    score=item.get("score")  # Score might be added by search relevance
-                )
-                matches.append(entity)
+        parsed = _DEC.decode(response.content)
+        # Using search API format (same as search function)
+        matches = [_build_entity(item) for item in parsed.results]
 
-            return MatchOfacEntityResponse(
-                success=True,
-                matches=matches
-            )
+        match_response = MatchOfacEntityResponse.model_construct(
+            success=True,
+            matches=matches
+        )
+        _SEARCH_CACHE[cache_key] = match_response
+        return match_response
 
-    except Exception as e:
+    # Only upstream failures become error responses, anything else is a bug and should surface
+    except httpx.HTTPError as e:
+        return MatchOfacEntityResponse(
+            success=False,
+            matches=[],
+            error=f"network: {e!r}"
+        )
+    except (msgspec.DecodeError, ValueError, KeyError) as e:
         return MatchOfacEntityResponse(
             success=False,
             matches=[],
-            error=str(e)
+            error=f"parse: {e!r}"
         )
 
+# Bulk variants for screening many names at once
+# The lookups fan out concurrently over the shared client, capped so we don't hammer OpenSanctions
+_BULK_SEMAPHORE = asyncio.Semaphore(20)
+
+async def _bounded(coro):
+    async with _BULK_SEMAPHORE:
+        return await coro
+
+@connector.register_query
+async def search_ofac_sdn_bulk(queries: list[str], limit: int | None = 10) -> list[SearchOfacSdnResponse]:
+    """Search the OFAC SDN sanctions database for each query concurrently, results are in query order"""
+    return await asyncio.gather(*(_bounded(search_ofac_sdn(query, limit)) for query in queries))
+
+@connector.register_query
+async def match_ofac_entity_bulk(names: list[str], country: str | None = None, entity_type: str | None = None) -> list[MatchOfacEntityResponse]:
+    """Match each name against the OFAC SDN sanctions database concurrently, results are in name order"""
+    return await asyncio.gather(*(_bounded(match_ofac_entity(name, country, entity_type)) for name in names))
+
 # Test function to check API key environment variable
+# Frozen because the startup response below is shared between every caller
 class ApiKeyTestResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     api_key_exists: bool = Field(..., description="Whether the API key environment variable exists")
     api_key_length: int = Field(..., description="Length of the API key (0 if not found)")
     api_key_preview: str = Field(..., description="First 10 characters of API key (masked if longer)")
     env_var_name: str = Field(..., description="Environment variable name being checked")
 
-@connector.register_query
-def test_api_key_env() -> ApiKeyTestResponse:
-    """Test function to verify OpenSanctions API key is properly configured in environment"""
-    env_var_name = "APP_OFAC_OPENSANCTIONS_API_KEY"
-    api_key = os.getenv(env_var_name)
+def _build_api_key_test_response(api_key: str | None) -> ApiKeyTestResponse:
+    env_var_name = OPENSANCTIONS_API_KEY_ENV_VAR
     
     if api_key:
         api_key_length = len(api_key)
-        # Show first 10 chars for verification, mask the rest
+        # Show first 10 chars for verification, mask the rest (the mask is capped so it stays small)
         if api_key_length > 10:
-            api_key_preview = api_key[:10] + "..." + ("*" * (api_key_length - 10))
+            api_key_preview = api_key[:10] + "..." + ("*" * min(32, api_key_length - 10))
         else:
             api_key_preview = api_key
         
-        return ApiKeyTestResponse(
+        return ApiKeyTestResponse.model_construct(
             api_key_exists=True,
             api_key_length=api_key_length,
             api_key_preview=api_key_preview,
             env_var_name=env_var_name
         )
     else:
-        return ApiKeyTestResponse(
+        return ApiKeyTestResponse.model_construct(
             api_key_exists=False,
             api_key_length=0,
             api_key_preview="[NOT FOUND]",
             env_var_name=env_var_name
         )
 
+# Built once for the key read at startup, which is the one the OFAC functions actually use
+_API_KEY_TEST_RESPONSE = _build_api_key_test_response(_API_KEY)
+
+@connector.register_query
+def test_api_key_env() -> ApiKeyTestResponse:
+    """Test function to verify OpenSanctions API key is properly configured in environment"""
+    # Reads the live environment rather than the cached key, since this is a diagnostic
+    api_key = _read_api_key()
+    if api_key == _API_KEY:
+        return _API_KEY_TEST_RESPONSE
+    return _build_api_key_test_response(api_key)
+
 if __name__ == "__main__":
     start(connector)